@@ -1,7 +1,73 @@
-import json
-from multiprocessing import Pool
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
+import diskcache
+import ijson
+import orjson
+import re
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import time
+from typing import NamedTuple
+import urllib3
+from urllib3.util import make_headers, Retry
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket for client-side throttling, so concurrent workers stay under a set rate.
+    Use as a context manager around each request: blocks until a token is available
+    '''
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class CountingRetry(Retry):
+    '''
+    urllib3 Retry that calls on_retry() each time a retry is actually going to be sent, so the
+    (otherwise transparent) retries can be counted
+    '''
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kwargs):
+        # urllib3 makes a new Retry for each attempt, so pass the callback along
+        return super().new(on_retry=self.on_retry, **kwargs)
+
+    def increment(self, *args, **kwargs):
+        # raises (and no more requests are sent) once retries are exhausted
+        retry = super().increment(*args, **kwargs)
+        if self.on_retry:
+            self.on_retry()
+        return retry
+
+class PriceBucket(NamedTuple):
+    '''
+    Price range for one subquery (much lighter than a dict, as there can be a lot of these)
+    '''
+    min_price: int
+    max_price: int
 
 class AutotraderAPI:
     '''
@@ -10,10 +76,64 @@ class AutotraderAPI:
     '''
     api_base_url = 'https://www.autotrader.com/rest/lsc/listing'
     record_request_threshold = 3800
-
-    def __init__(self):
-        # self.api_req_count = 0
-        pass
+    max_workers = 8
+    requests_per_second = 5
+    # probes sent per search step in _find_max_price; 1 is a plain binary search. Extra (speculative) probes
+    # only pay off when requests_per_second isn't the bottleneck, since every probe spends a limiter token
+    probe_batch_size = 1
+    cache_dir = './.autotrader_cache'
+    # record counts are pretty stable, so probes can be cached longer than the listings themselves
+    probe_cache_ttl = 900
+    listings_cache_ttl = 300
+    # placeholder price params in prepared request templates, rebound per request
+    price_params_pattern = re.compile(r'([?&])(minPrice|maxPrice)=0(?=&|$)')
+
+    def __init__(self, listing_fields: set = None):
+        '''
+        listing_fields: optional set of listing field names to keep, to drop the (many) fields of each
+        listing that aren't needed downstream; all fields are kept if not set
+        '''
+        # count of requests actually sent (not served from the cache), including the adapter's retries;
+        # shared by all worker threads
+        self.api_req_count = 0
+        self._api_req_count_lock = threading.Lock()
+        self.listing_fields = listing_fields
+
+        # retries (with exponential back-off, honoring Retry-After on 429/503) are handled
+        # transparently by the adapter
+        retry = CountingRetry(
+            on_retry=self._count_request,
+            total=5,
+            backoff_factor=0.25,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            raise_on_status=False
+        )
+
+        # single keep-alive session shared by all worker threads (safe for concurrent GETs),
+        # with a connection pool sized so every worker gets a hot connection. pool_block makes a thread
+        # wait for a pooled connection instead of opening (and then throwing away) an extra one
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, pool_block=True, max_retries=retry)
+        self.session.mount('https://', adapter)
+        # accept every encoding urllib3 can decode here (i.e. gzip, deflate, plus br if brotli is installed)
+        self.session.headers.update(make_headers(accept_encoding=True))
+
+        # shared by every request, so raising max_workers doesn't trip the API rate limit
+        self.limiter = TokenBucket(rate=self.requests_per_second, capacity=self.requests_per_second)
+
+        # responses cached on disk, so repeated runs with the same params skip the network
+        self.cache = diskcache.Cache(self.cache_dir)
+
+        self._probe_size_logged = False
+
+        # prepared requests to copy for each set of params other than 'minPrice' and 'maxPrice'
+        self._prepared_templates = {}
+
+        # requests currently in flight, so concurrent callers with the same params wait on the first
+        # caller's response rather than sending a duplicate request
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
     def run_query(self, query_params: dict = None):
         if not query_params:
@@ -29,182 +149,282 @@ class AutotraderAPI:
             }
         ## TODO: add more of the API params / check for valid params?
    
-        subqueries_list = self.build_subqueries(query_params)
-
-        # combine each subquery params with main params 
-        subqueries_params = [{**query_params, **subquery_params} for subquery_params in subqueries_list]
+        price_buckets = self.build_subqueries(query_params)
 
-        records = self.run_subqueries(subqueries_params)
+        # combine each price range with the main params
+        subqueries_params = [
+            {**query_params, 'minPrice': bucket.min_price, 'maxPrice': bucket.max_price} for bucket in price_buckets
+        ]
 
+        # listings are written out (one json object per line) as each subquery completes, rather than
+        # buffering every listing in memory until the end
         try:
-            with open('autotrader_query_output.json', 'w') as f:
-                json.dump(records, f, indent=4)
-        except Exception as e:
+            with open('autotrader_query_output.ndjson', 'wb') as f:
+                records_count = self.run_subqueries(subqueries_params, f)
+        except OSError as e:
             print("Error: could not save output: ", e)
-        print('Output saved to json file!')
+            return
+        print('Output saved to ndjson file!')
 
-        print('Total listings fetched: ', len(records))
-        # print('Requests count: ', self.api_req_count)
+        print('Total listings fetched: ', records_count)
+        print('Requests count: ', self.api_req_count)
 
     def build_subqueries(self, main_query_params: dict) -> list:
         '''
         Get subqueries for price ranges 
         i.e.: [
-            {'minPrice':0,'maxPrice':10465}, 
-            {'minPrice':10466, 'maxPrice':17622}
+            PriceBucket(min_price=0, max_price=10465), 
+            PriceBucket(min_price=10466, max_price=17622)
             , ... , 
-            {'minPrice':123789, 'maxPrice':150000}
+            PriceBucket(min_price=123789, max_price=150000)
             ]
 
         Currently only using 'minPrice' and 'maxPrice' as range of values to query, but could work for 
         'startYear' and 'endYear' if it's not a huge query 
         (otherwise count of results per year would probably be too high)
 
-        Note: using a forward forward search method
+        Note: using a binary search on 'maxPrice' for each price range (see _find_max_price)
         '''
         print('Started building subqueries list...')
-        subquery_params = {**main_query_params, 'numRecords': 0} 
+        probe_params = {**main_query_params, 'numRecords': 0}
+        global_max_price = main_query_params['maxPrice']
         price_subqueries = []
 
+        # record counts already fetched for each (minPrice, maxPrice), shared by the probe threads so no
+        # range is probed twice
+        probe_counts = {}
+
         # get initial record count
-        query_size_req = requests.get(self.api_base_url, headers={'Accept-Encoding': 'gzip, deflate'}, params=subquery_params)
-        total_remaining_records = query_size_req.json().get('totalResultCount', 0)
+        current_min_price = main_query_params['minPrice']
+        initial_records = self._probe_count(probe_params, current_min_price, global_max_price, probe_counts)
+        total_remaining_records = initial_records
 
-        print('Initial records available: ', total_remaining_records)
+        print('Initial records available: ', initial_records)
 
-        # initial price step calculation
-        next_price_step = int((self.record_request_threshold / total_remaining_records) * subquery_params['maxPrice'])
-        subquery_params['maxPrice'] = next_price_step
-        highest_seen_current = None
+        # probes are sent in parallel batches, sharing the session and rate limiter with everything else
+        with ThreadPoolExecutor(max_workers=self.probe_batch_size) as probe_executor:
+            while current_min_price <= global_max_price:
+                current_max_price, subquery_available_records = self._find_max_price(
+                    probe_params, current_min_price, global_max_price, probe_counts, probe_executor
+                )
 
-        # track count of each sub-step (searching each price range)
-        sub_step_count = 0
+                # stop when no more records found
+                if subquery_available_records == 0 and current_max_price == global_max_price:
+                    break
 
-        # start forward search loop
-        while True:
-            sub_step_count += 1
-            resp = requests.get(self.api_base_url, headers={'Accept-Encoding': 'gzip, deflate'}, params=subquery_params)
-            # self.api_req_count += 1
-            json_resp = resp.json()
-            # query_resp_listings = json_resp.get('listings', [])
-            subquery_available_records = json_resp.get('totalResultCount', 0)
-
-            current_min_price = subquery_params['minPrice']
-            current_max_price = subquery_params['maxPrice']
-
-            # stop if upper price limit reached
-            if current_max_price == main_query_params['maxPrice']:
-                price_subqueries.append({
-                    'minPrice': current_min_price,
-                    'maxPrice': current_max_price,
-                    'expected_count': subquery_available_records
-                })
-                break
-
-            # stop when no more records found
-            if subquery_available_records == 0:
-                break
-
-            # adjust the max price if the number of query records is too high or low
-            if subquery_available_records > self.record_request_threshold or \
-                (subquery_available_records < self.record_request_threshold and self.record_request_threshold - subquery_available_records > 1000):
-
-                # calculate the next step in price relative to records available
-                # TODO: tweak to improve performance?
-                rel_step = int((self.record_request_threshold / subquery_available_records) * next_price_step)
-        
-                # force step size minimum 
-                min_step_size = 500
-                if abs(rel_step - next_price_step) < min_step_size:
-                    if rel_step < next_price_step:
-                        rel_step = next_price_step - min_step_size
-                    elif rel_step > next_price_step:
-                        rel_step = next_price_step + min_step_size
-
-                # Limit step increase to 2x the previous step to avoid too large jumps
-                next_price_step = min(rel_step, next_price_step * 2)
-
-                # Update highest_seen_current only if the record count exceeds the threshold
-                if subquery_available_records > self.record_request_threshold:
-                    if highest_seen_current is None:
-                        highest_seen_current = current_max_price
-                    elif current_max_price > highest_seen_current:
-                        # print(f'Records exceed threshold! Updating highest_seen_current: {current_max_price}')
-                        highest_seen_current = current_max_price
-
-                # check if step is too high when increasing the price step (too few records)
-                if highest_seen_current is not None and next_price_step > highest_seen_current:
-                    # print(f'Next step ({next_price_step}) too high! Highest seen current = {highest_seen_current}')
-                    next_price_step = int((highest_seen_current - current_max_price) / 2) + current_max_price
-
-                subquery_params['maxPrice'] = current_min_price + next_price_step
-
-                # Ensure the maxPrice does not exceed the main maxPrice
-                if subquery_params['maxPrice'] > main_query_params['maxPrice']:
-                    subquery_params['maxPrice'] = main_query_params['maxPrice']
-
-            else:
-                # if number of records is within threshold, save subquery and move to the next range
-                price_subqueries.append({
-                    'minPrice': current_min_price,
-                    'maxPrice': current_max_price,
-                    # 'expected_count': subquery_available_records,
-                    # 'substep_count': sub_step_count
-                })
-                highest_seen_current = None
-                sub_step_count = 0
+                price_subqueries.append(PriceBucket(current_min_price, current_max_price))
                 total_remaining_records -= subquery_available_records
 
-                # set the starting price range for the next "bucket" of price ranges
-                # assuming a normalish distribution, just initially repeat the last range that worked
-                next_price_step = current_max_price - current_min_price
-                subquery_params['minPrice'] = current_max_price + 1
-                subquery_params['maxPrice'] = current_max_price + next_price_step \
-                    if current_max_price + next_price_step < main_query_params['maxPrice'] else main_query_params['maxPrice']
+                # set the starting price for the next "bucket" of price ranges
+                current_min_price = current_max_price + 1
+
+        # sanity check that the price ranges cover every record initially available
+        if total_remaining_records != 0:
+            print(f'WARNING: price ranges cover {initial_records - total_remaining_records} of the {initial_records} '
+                  'records initially available (listings may have changed while building subqueries)')
 
         # print(f'\nPrice subqueries (count: {len(price_subqueries)}):')
         # for q in price_subqueries:
         #     print(q)
-        # print(f'Request count: {self.api_req_count}')
         print('Finished building subqueries list...')
         
-        return [{k:v for k, v in q.items() if k in ('minPrice', 'maxPrice')} for q in price_subqueries]
-       
-    def make_request(self, api_params: dict) -> list:
+        return price_subqueries
+
+    def _find_max_price(self, probe_params: dict, min_price: int, global_max_price: int, probe_counts: dict,
+                        probe_executor: ThreadPoolExecutor) -> tuple:
         '''
-        Request records from the api, using 'minPrice' and 'maxPrice' params
+        Search for the 'maxPrice' of the price range starting at min_price, so that the range's
+        record count is within [record_request_threshold - 1000, record_request_threshold]
+
+        Each step probes probe_batch_size evenly spaced prices at once (i.e. the midpoint when 1, or the quartiles
+        of the current interval when 3), then narrows the interval to whichever pair of candidates brackets the threshold
+
+        Returns (max_price, record count)
         '''
-        # send request and check response, resend up to 5 times with a delay if response empty
-        retry_count = 5
-        while True:
-            response = requests.get(self.api_base_url, headers={'Accept-Encoding': 'gzip, deflate'}, params=api_params, timeout=10)
-            # self.api_req_count += 1
+        # the whole remaining range fits in one subquery
+        remaining_records = self._probe_count(probe_params, min_price, global_max_price, probe_counts)
+        if remaining_records <= self.record_request_threshold:
+            return global_max_price, remaining_records
+
+        # invariant: count at hi is over the threshold, count at lo is under the threshold once lo has been
+        # probed (lo starts at min_price, which isn't checked until the fallback below)
+        lo, hi = min_price, global_max_price
+        while hi - lo > 1:
+            step = (hi - lo) / (self.probe_batch_size + 1)
+            candidate_prices = sorted({lo + max(1, int(step * i)) for i in range(1, self.probe_batch_size + 1)})
+            candidate_prices = [price for price in candidate_prices if price < hi]
+            candidate_counts = probe_executor.map(
+                lambda price: self._probe_count(probe_params, min_price, price, probe_counts), candidate_prices
+            )
+
+            # counts only increase with price, so keep the highest candidate within the band
+            best_candidate = None
+            for price, count in zip(candidate_prices, candidate_counts):
+                if count > self.record_request_threshold:
+                    hi = price
+                    break
+                elif self.record_request_threshold - count > 1000:
+                    lo = price
+                else:
+                    best_candidate = (price, count)
+            if best_candidate:
+                return best_candidate
+
+        # no max price lands within the band (i.e. lots of listings at the same price), so take the
+        # largest range that's under the threshold
+        lo_count = self._probe_count(probe_params, min_price, lo, probe_counts)
+        if lo_count > self.record_request_threshold:
+            # can't split a single price any further, so the subquery will only return part of its records
+            print(f'WARNING: {lo_count} records at price {lo} exceed the per-request limit of '
+                  f'{self.record_request_threshold}; {lo_count - self.record_request_threshold} will not be fetched')
+        return lo, lo_count
+
+    def _probe_count(self, probe_params: dict, min_price: int, max_price: int, probe_counts: dict) -> int:
+        '''
+        Get the count of records available for a price range (without fetching any listings)
+        '''
+        if (min_price, max_price) not in probe_counts:
+            probe_counts[(min_price, max_price)] = self._cached_get(
+                {**probe_params, 'minPrice': min_price, 'maxPrice': max_price},
+                ttl=self.probe_cache_ttl,
+                read_response=self._read_result_count
+            )
+        return probe_counts[(min_price, max_price)]
+
+    def get(self, params: dict) -> requests.Response:
+        '''
+        Throttled GET request to the api; the response body is streamed, so it can be parsed incrementally
+        from response.raw (decompressed)
+        '''
+        prepped = self._prepare_request(params)
+        self._count_request()
+        with self.limiter:
+            resp = self.session.send(prepped, timeout=10, stream=True)
+        resp.raw.decode_content = True
+        return resp
+
+    def _count_request(self):
+        with self._api_req_count_lock:
+            self.api_req_count += 1
+
+    def _prepare_request(self, params: dict) -> requests.PreparedRequest:
+        '''
+        Prepare a GET request for the params; since only 'minPrice' and 'maxPrice' change between requests,
+        copy a template prepared once for the other params and just rebind the prices in its url
+        (skipping the urlencoding and request building each time)
+        '''
+        if 'minPrice' not in params or 'maxPrice' not in params:
+            return self.session.prepare_request(requests.Request('GET', self.api_base_url, params=params))
+
+        base_key = tuple(sorted((k, v) for k, v in params.items() if k not in ('minPrice', 'maxPrice')))
+        template = self._prepared_templates.get(base_key)
+        if template is None:
+            template = self.session.prepare_request(
+                requests.Request('GET', self.api_base_url, params={**params, 'minPrice': 0, 'maxPrice': 0})
+            )
+            self._prepared_templates[base_key] = template
+
+        prepped = template.copy()
+        prepped.url = self.price_params_pattern.sub(
+            lambda m: f'{m[1]}{m[2]}={int(params[m[2]])}', template.url
+        )
+
+        # the template's Cookie header is a snapshot from when it was prepared, so swap in the session's
+        # current cookies (i.e. ones set by the server since then)
+        prepped.headers.pop('Cookie', None)
+        prepped.prepare_cookies(self.session.cookies)
+        return prepped
+
+    def _cached_get(self, params: dict, ttl: int, read_response):
+        '''
+        GET request to the api returning read_response(response), served from the disk cache when the
+        same params were requested within the last ttl seconds, or from the response of an identical
+        request that's already in flight
+        '''
+        # listings are cached already projected down to listing_fields, so those are part of the key
+        key = ('GET', self.api_base_url, tuple(sorted(params.items())), tuple(sorted(self.listing_fields or ())))
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        with self._inflight_lock:
+            inflight = self._inflight.get(key)
+            is_first_caller = inflight is None
+            if is_first_caller:
+                inflight = self._inflight[key] = Future()
+        if not is_first_caller:
+            return inflight.result()
+
+        try:
+            with self.get(params) as resp:
+                resp.raise_for_status()
+                result = read_response(resp)
+            self.cache.set(key, result, expire=ttl)
+            inflight.set_result(result)
+        except Exception as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+        return result
+
+    def _read_result_count(self, resp: requests.Response) -> int:
+        '''
+        Stream-parse just 'totalResultCount' from a response, without building the rest of the json
+        '''
+        total_result_count = next(ijson.items(resp.raw, 'totalResultCount'), 0)
+        # read the rest of the (small) response so the connection goes back to the pool for reuse
+        resp.raw.drain_conn()
 
-            json_response = response.json()
-            if len(list(json_response.keys())) > 0:
-                break
+        # log the size on the wire of the first probe once, to check that probes stay minimal (and compressed)
+        if not self._probe_size_logged:
+            self._probe_size_logged = True
+            print(f'Probe response size: {resp.raw.tell()} bytes ({resp.headers.get("Content-Encoding", "uncompressed")})')
+        return total_result_count
 
-            retry_count -= 1
-            if retry_count < 0:
-                break
-            print('ERROR: no response? Sleeping for 5 seconds and retrying...')
-            time.sleep(5)
+    def _read_listings(self, resp: requests.Response) -> list:
+        '''
+        Stream-parse the 'listings' array from a response one listing at a time, projecting each listing
+        down to listing_fields (if set) as it's parsed so full listings are never all held in memory
+        '''
+        listings = ijson.items(resp.raw, 'listings.item', use_float=True)
+        if self.listing_fields:
+            return [{k: listing[k] for k in self.listing_fields if k in listing} for listing in listings]
+        return list(listings)
 
-        response_listings = json_response.get('listings', [])
-       
-        # print('TEST parameters per listing: ', len(json_response.get('listings',[{}])[0].keys()))
-        # test_string = f'TEST number of listings: returned: {len(json_response.get("listings", []))}; total: {json_response.get("totalResultCount")}'
+    def make_request(self, api_params: dict) -> list:
+        '''
+        Request records from the api, using 'minPrice' and 'maxPrice' params
+        '''
+        # responses are streamed, so failures while reading the body come from urllib3/ijson directly
+        # (i.e. a dropped connection mid-body) rather than being wrapped by requests
+        try:
+            response_listings = self._cached_get(api_params, ttl=self.listings_cache_ttl, read_response=self._read_listings)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError) as e:
+            print(f'ERROR: request failed for price range {api_params.get("minPrice")}-{api_params.get("maxPrice")}: ', e)
+            return []
 
-        return response_listings #, test_string
+        return response_listings
        
-    def run_subqueries(self, subqueries_params: list) -> list:
+    def run_subqueries(self, subqueries_params: list, output_file) -> int:
+        '''
+        Run each subquery, writing the listings to output_file (opened in binary mode) as newline-delimited
+        json as soon as each subquery completes
+
+        Returns the count of listings written
+        '''
         print('Started running subqueries...')
-        all_listings = []
-        with Pool(processes=4) as pool:
-            for listings in pool.map(self.make_request, subqueries_params):
-                all_listings.extend(listings)
+        listings_count = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.make_request, subquery_params) for subquery_params in subqueries_params]
+            for future in as_completed(futures):
+                listings = future.result()
+                # one write per subquery, with the newline appended by orjson itself
+                output_file.write(b''.join(orjson.dumps(listing, option=orjson.OPT_APPEND_NEWLINE) for listing in listings))
+                listings_count += len(listings)
         print('Finished running subqueries...')
-        return all_listings
+        return listings_count
 
 if __name__ == "__main__":
     api = AutotraderAPI()